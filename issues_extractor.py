@@ -1,9 +1,31 @@
 import jira
 import git
+from git.objects.util import from_timestamp, utctz_to_altz
 import time
 import re
 import json
-from datetime import datetime
+import math
+import logging as log
+import bisect
+from collections import namedtuple
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+# fields requested from Jira; requesting only these keeps every search page small.
+# JiraIssue copies every returned non-custom field, so JiraIssue.fields only contains these ones
+JIRA_ISSUE_FIELDS = "issuetype,priority,resolution,created,summary"
+# issue keys per query when fetching selected issues, keeps the JQL within the URL length limits
+JIRA_KEYS_PER_QUERY = 200
+# consecutive rate limited responses tolerated before giving up
+JIRA_MAX_RATE_LIMIT_RETRIES = 10
+# drops punctuation and splits words on separators before looking for issue ids in commit messages
+_COMMIT_TEXT_TABLE = str.maketrans("-_.=", "    ", "[]?#,:(){}'\"")
+_EPOCH = datetime(1970, 1, 1)
+# moved part of a renamed file path, e.g. {org/apache/tika/fork => test-documents}
+_RENAME_RE = re.compile(r"\{([^}]*?) => ([^}]*?)\}")
+_DIGIT_RE = re.compile(r"\d")
+# whitespace separated words made only of digits
+_NUMBER_WORD_RE = re.compile(r"(?<!\S)\d+(?!\S)")
 
 
 class Issue(object):
@@ -28,13 +50,13 @@ class JiraIssue(Issue):
     def __init__(self, issue, base_url):
         super().__init__(issue.key.strip().split('-')[1], issue.fields.issuetype.name.lower(), JiraIssue.get_name_or_default(issue.fields.priority, 'minor'), JiraIssue.get_name_or_default(issue.fields.resolution, 'resolved'), base_url, datetime.strptime(issue.fields.created, "%Y-%m-%dT%H:%M:%S.%f%z"))
         self.fields = {}
-        for k, v in dict(issue.fields.__dict__).items():
+        for k, v in issue.fields.__dict__.items():
             if k.startswith("customfield_") or k.startswith("__"):
                 continue
             if type(v) in [str, type(None), type(0), type(0.1)]:
-                self.fields[k] = str(v)
+                self.fields[k] = ' '.join(str(v).split())
             elif hasattr(v, 'name'):
-                self.fields[k] = v.name.replace('\n', '').replace(';', '.,')
+                self.fields[k] = ' '.join(v.name.replace('\n', '').replace(';', '.,').split())
             elif type(v) in [list, tuple]:
                 lst = []
                 for item in v:
@@ -42,9 +64,7 @@ class JiraIssue(Issue):
                         lst.append(item)
                     elif hasattr(item, 'name'):
                         lst.append(item.name)
-                self.fields[k] = "@@@".join(lst)
-        for k in self.fields:
-            self.fields[k] = ' '.join(self.fields[k].split())
+                self.fields[k] = ' '.join("@@@".join(lst).split())
 
     @staticmethod
     def get_name_or_default(val, default):
@@ -53,24 +73,151 @@ class JiraIssue(Issue):
         return default
 
 
-def get_jira_issues(project_name, url="http://issues.apache.org/jira", bunch=100):
-    jira_conn = jira.JIRA(url)
+def _parse_retry_after(value):
+    """
+    parse a Retry-After header, given either in seconds or as an HTTP date.
+    :return: seconds to wait, None if the value cannot be parsed
+    """
+    try:
+        seconds = float(value)
+        return max(0.0, seconds) if math.isfinite(seconds) else None
+    except ValueError:
+        pass
+    try:
+        retry_date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_date is None:
+        return None
+    if retry_date.tzinfo is None:
+        retry_date = retry_date.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_date - datetime.now(timezone.utc)).total_seconds())
+
+
+def _get_jira_rate_limit(error):
+    """
+    read the rate limit headers of a failed Jira request.
+    :param error: jira.exceptions.JIRAError raised by the request
+    :return: (seconds to wait before retrying, seconds to wait between successful requests), None if not available
+    """
+    if error.response is None:
+        return None, None
+    headers = error.response.headers
+    retry_after = None
+    pacing = None
+    if 'Retry-After' in headers:
+        retry_after = _parse_retry_after(headers['Retry-After'])
+    if 'X-RateLimit-Interval-Seconds' in headers and 'X-RateLimit-FillRate' in headers:
+        try:
+            pacing = float(headers['X-RateLimit-Interval-Seconds']) / float(headers['X-RateLimit-FillRate'])
+        except (ValueError, ZeroDivisionError):
+            pacing = None
+    return retry_after, pacing
+
+
+def _backoff(sleep_time, e):
+    sleep_time = sleep_time * 2
+    if sleep_time >= 480:
+        raise e
+    time.sleep(sleep_time)
+    return sleep_time
+
+
+def _search_jira_issues(jira_conn, jql, bunch, validate_query=True, max_issues=None):
+    """
+    fetch all the issues matching a JQL query, page by page, honouring the rate limits of the server.
+    :return: (list of fetched issues, total number of issues matching the query)
+    """
     all_issues=[]
+    total = 0
     extracted_issues = 0
     sleep_time = 30
+    pacing_time = 0
+    rate_limit_retries = 0
     while True:
         try:
-            issues = jira_conn.search_issues("project={0}".format(project_name), maxResults=bunch, startAt=extracted_issues)
+            issues = jira_conn.search_issues(jql, maxResults=bunch, startAt=extracted_issues, fields=JIRA_ISSUE_FIELDS,
+                                             expand=None, json_result=False, validate_query=validate_query)
             all_issues.extend(issues)
-            extracted_issues=extracted_issues+bunch
-            if len(issues) < bunch:
+            total = issues.total
+            extracted_issues=extracted_issues+len(issues)
+            if max_issues is not None and extracted_issues >= max_issues:
                 break
-        except Exception as e:
-            sleep_time = sleep_time * 2
-            if sleep_time >= 480:
+            if len(issues) < bunch:
+                if 0 < len(issues) and extracted_issues < issues.total:
+                    log.warning(f"Jira server returned {len(issues)} issues instead of {bunch}, using it as page size")
+                    bunch = len(issues)
+                else:
+                    break
+            rate_limit_retries = 0
+            if pacing_time:
+                time.sleep(pacing_time)
+        except jira.exceptions.JIRAError as e:
+            retry_after, pacing = _get_jira_rate_limit(e)
+            if retry_after is None and not pacing and e.status_code != 429:
+                # not a rate limit (e.g. bad query or missing permissions), retrying cannot help
+                raise e
+            rate_limit_retries += 1
+            if rate_limit_retries > JIRA_MAX_RATE_LIMIT_RETRIES:
                 raise e
-            time.sleep(sleep_time)
-    return list(map(lambda issue: JiraIssue(issue, url), all_issues))
+            if pacing:
+                pacing_time = pacing
+            if retry_after is not None:
+                time.sleep(retry_after)
+            elif pacing:
+                time.sleep(pacing)
+            else:
+                sleep_time = _backoff(sleep_time, e)
+        except Exception as e:
+            sleep_time = _backoff(sleep_time, e)
+    return all_issues, total
+
+
+def _search_jira_issues_by_ids(jira_conn, project_name, issue_ids, bunch):
+    """
+    fetch only the given issues of a Jira project, querying them by key.
+    :return: list of issues, None if fetching the whole project takes fewer requests
+    """
+    # _commits_and_issues keeps the oldest issue of the project for the commits older than every issue,
+    # so it is fetched as well to link those commits exactly as when fetching the whole project
+    oldest_jql = "project={0} ORDER BY created ASC".format(project_name)
+    oldest_issues, total = _search_jira_issues(jira_conn, oldest_jql, 1, max_issues=1)
+    if not oldest_issues:
+        return []
+    # candidates are any number found in the commits (versions, years, ...), those above the last issue do not exist
+    newest_jql = "project={0} ORDER BY key DESC".format(project_name)
+    newest_issues, _ = _search_jira_issues(jira_conn, newest_jql, 1, max_issues=1)
+    max_issue_id = int(newest_issues[0].key.split('-')[-1])
+    issue_keys = sorted("{0}-{1}".format(project_name, issue_id) for issue_id in issue_ids
+                        if int(issue_id) <= max_issue_id)
+    if math.ceil(len(issue_keys) / JIRA_KEYS_PER_QUERY) >= math.ceil(total / bunch):
+        return None
+    all_issues = []
+    for i in range(0, len(issue_keys), JIRA_KEYS_PER_QUERY):
+        jql = "project={0} AND key in ({1})".format(project_name, ",".join(issue_keys[i:i + JIRA_KEYS_PER_QUERY]))
+        # without validation, keys of missing issues are ignored instead of failing the whole query
+        all_issues.extend(_search_jira_issues(jira_conn, jql, bunch, validate_query=False)[0])
+    fetched_keys = {issue.key for issue in all_issues}
+    all_issues.extend(issue for issue in oldest_issues if issue.key not in fetched_keys)
+    return all_issues
+
+
+def get_jira_issues(project_name, url="http://issues.apache.org/jira", bunch=500, issue_ids=None):
+    """
+    fetch the issues of a Jira project.
+    :param project_name: Jira project key
+    :param url: url of the Jira server
+    :param bunch: number of issues requested per page
+    :param issue_ids: if set, only the issues with these numeric ids are fetched (e.g. '123' for <project_name>-123)
+    :return: list of JiraIssue
+    """
+    jira_conn = jira.JIRA(url)
+    all_issues = None
+    if issue_ids is not None:
+        all_issues = _search_jira_issues_by_ids(jira_conn, project_name, issue_ids, bunch)
+    if all_issues is None:
+        all_issues, _ = _search_jira_issues(jira_conn, "project={0}".format(project_name), bunch)
+    return [JiraIssue(issue, url) for issue in all_issues]
 
 def _clean_commit_message(commit_message):
     if "git-svn-id" in commit_message:
@@ -91,14 +238,14 @@ def fix_renamed_files(files):
     new_files = []
     for file in files:
         if "=>" in file:
-            if "{" and "}" in file:
+            match = _RENAME_RE.search(file)
+            if match:
                 # file moved
-                src, dst = file.split("{")[1].split("}")[0].split("=>")
-                fix = lambda repl: re.sub(r"{[\.a-zA-Z_/\-0-9]* => [\.a-zA-Z_/\-0-9]*}", repl.strip(), file)
-                new_files.extend(map(fix, [src, dst]))
+                prefix, suffix = file[:match.start()], file[match.end():]
+                new_files.extend([prefix + match.group(1).strip() + suffix, prefix + match.group(2).strip() + suffix])
             else:
                 # full path changed
-                new_files.extend(map(lambda x: x.strip(), file.split("=>")))
+                new_files.extend(x.strip() for x in file.split("=>"))
                 pass
         else:
             new_files.append(file)
@@ -106,9 +253,12 @@ def fix_renamed_files(files):
 
 
 class CommittedFile(object):
-    def __init__(self, sha, name, insertions, deletions):
+    def __init__(self, sha, name, insertions, deletions, already_fixed=False):
         self.sha = sha
-        self.name = fix_renamed_files([name])[0]
+        if already_fixed or "=>" not in name:
+            self.name = name
+        else:
+            self.name = fix_renamed_files([name])[0]
         if insertions.isnumeric():
             self.insertions = int(insertions)
             self.deletions = int(deletions)
@@ -122,32 +272,94 @@ class CommittedFile(object):
         return {'commit_sha': self.sha, 'file_name': self.name, 'is_java': self.is_java, 'is_test': self.is_test, 'added_lines': self.insertions, 'deleted_lines': self.deletions}
 
 
+def _read_nul_separated(stream, chunk_size=1 << 16):
+    buffer = b''
+    for chunk in iter(lambda: stream.read(chunk_size), b''):
+        tokens = (buffer + chunk).split(b'\x00')
+        buffer = tokens.pop()
+        for token in tokens:
+            yield token.decode('utf-8', 'replace')
+    if buffer:
+        yield buffer.decode('utf-8', 'replace')
+
+
+def _git_log_records(repo, header_format, *args):
+    """
+    stream the output of git log -z, one commit at a time.
+    with -z, paths are never quoted and renamed files are reported as two separate fields (old path, new path).
+    :param repo: git.Repo
+    :param header_format: git pretty format of the commit header, it must not output NUL bytes
+    :param args: extra git log arguments describing the files (e.g. --numstat)
+    :return: generator of (commit header, list of the NUL separated fields describing the commit files)
+    """
+    proc = repo.git.log('-z', '--pretty=format:{0}%x00'.format(header_format), *args, as_process=True)
+    header = None
+    fields = []
+    for token in _read_nul_separated(proc.stdout):
+        if header is None:
+            header = token
+        elif token:
+            fields.append(token.lstrip('\n'))
+        else:
+            yield header, fields
+            header = None
+            fields = []
+    if header is not None:
+        yield header, fields
+    proc.wait()
+
+
+class LoggedCommit(namedtuple('LoggedCommit', ['repo', 'hexsha', 'committed_datetime', 'parents', 'message', 'files'])):
+    """
+    lightweight replacement of git.Commit read from git log, so that commits do not have to be loaded one by one.
+    it exposes the git.Commit attributes used by Commit, plus the files changed by the commit.
+    """
+    __slots__ = ()
+
+
+def _committed_datetime(committed_date, committed_iso):
+    """
+    build the commit datetime exactly as git.Commit.committed_datetime does, including its tzinfo: time.mktime
+    depends on the tzinfo dst(), so Commit dates would otherwise differ on hosts observing DST.
+    :param committed_date: committer timestamp (%ct)
+    :param committed_iso: committer date in strict ISO 8601 (%cI), only its trailing +hh:mm offset is used
+    :return: timezone aware datetime
+    """
+    return from_timestamp(int(committed_date), utctz_to_altz(committed_iso[-6:].replace(':', '')))
+
+
 def _get_commits_files(repo):
-    data = repo.git.log('--numstat','--pretty=format:"sha: %H"').split("sha: ")
+    """
+    read all the commits of the repository, with their changed files, from a single git log.
+    :param repo: git.Repo
+    :return: dict of commit sha -> LoggedCommit, commits without changed files are skipped
+    """
     comms = {}
-    for d in data[1:]:
-        d = d.replace('"', '').replace('\n\n', '\n').split('\n')
-        commit_sha = d[0]
-        comms[commit_sha] = []
-        for x in d[1:-1]:
+    # fields of the header are separated by \x01, the message is the last one as it may contain anything else
+    for header, fields in _git_log_records(repo, '%H%x01%ct%x01%cI%x01%P%x01%B', '--numstat'):
+        commit_sha, committed_date, committed_iso, parents, message = header.split('\x01', 4)
+        files = []
+        fields = iter(fields)
+        for x in fields:
             insertions, deletions, name = x.split('\t')
-            names = fix_renamed_files([name])
-            comms[commit_sha].extend(list(map(lambda n: CommittedFile(commit_sha, n, insertions, deletions), names)))
-    return dict(map(lambda x: (x, comms[x]), filter(lambda x: comms[x], comms)))
+            # renamed files have an empty name followed by the old and the new path
+            names = [name] if name else [next(fields), next(fields)]
+            files.extend(CommittedFile(commit_sha, n, insertions, deletions, already_fixed=True) for n in names)
+        if files:
+            comms[commit_sha] = LoggedCommit(repo, commit_sha, _committed_datetime(committed_date, committed_iso),
+                                             tuple(parents.split()), message, files)
+    return comms
 
 
 def _get_commits_files_status(repo):
-    data = repo.git.log('--name-status','--pretty=format:"sha: %H"').split("sha: ")
     ans = []
-    for d in data[1:]:
-        d = d.replace('"', '').replace('\n\n', '\n').split('\n')
-        commit_sha = d[0]
-        #comms[commit_sha] = []
-        for x in d[1:-1]:
-            file_status = x.split('\t')
-            modification_type = file_status[0][0]
-            names = file_status[1:]
-            ans.extend(list(map(lambda n: (commit_sha, n, modification_type), filter(lambda x: x.endswith('.java'), names))))
+    for commit_sha, fields in _git_log_records(repo, '%H', '--name-status'):
+        fields = iter(fields)
+        for x in fields:
+            modification_type = x[0]
+            # renamed and copied files are followed by the old and the new path
+            names = [next(fields), next(fields)] if modification_type in 'RC' else [next(fields)]
+            ans.extend((commit_sha, n, modification_type) for n in names if n.endswith('.java'))
     return ans
 
 
@@ -159,7 +371,7 @@ class Commit(object):
         if files:
             self._files = files
         else:
-            self._files = list(map(lambda f: CommittedFile(self._commit_id, f, '0', '0'), git_commit.stats.files.keys()))
+            self._files = [CommittedFile(self._commit_id, f, '0', '0') for f in git_commit.stats.files.keys()]
         self._methods = list()
         self._commit_date = time.mktime(git_commit.committed_datetime.timetuple())
         self._commit_formatted_date = datetime.utcfromtimestamp(self._commit_date).strftime('%Y-%m-%d %H:%M:%S')
@@ -169,75 +381,93 @@ class Commit(object):
         else:
             self.issue_type = ''
         self.is_java_commit = is_java_commit
-        self.is_all_tests = all(list(map(lambda x: not x.is_test, self._files)))
+        self.is_all_tests = not any(x.is_test for x in self._files)
 
     @classmethod
     def init_commit_by_git_commit(cls, git_commit, bug_id='0', issue=None, files=None, is_java_commit=True):
         return Commit(bug_id, git_commit, issue, files=files, is_java_commit=is_java_commit)
 
 
-def _commits_and_issues(repo, jira_issues):
-    issues = dict(map(lambda x: (x.issue_id, x), jira_issues))
-    issues_dates = sorted(list(map(lambda x: (x, issues[x].creation_time), issues)), key=lambda x: x[1], reverse=True)
-    def replace(chars_to_replace, replacement, s):
-        temp_s = s
-        for c in chars_to_replace:
-            temp_s = temp_s.replace(c, replacement)
-        return temp_s
+def _get_commit_text_numbers(commit_text):
+    """
+    yield the numbers mentioned in a commit message, the candidates to be the id of the fixed issue.
+    """
+    if not _DIGIT_RE.search(commit_text):
+        return
+    text = commit_text.lower().translate(_COMMIT_TEXT_TABLE)
+    text = text.replace('bug', '').replace('fix', '')
+    for word in _NUMBER_WORD_RE.finditer(text):
+        yield word.group()
+
 
+def _get_candidate_issue_ids(java_commits):
+    """
+    collect the numbers mentioned by the messages of the commits that _commits_and_issues links to issues.
+    :param java_commits: LoggedCommit list, as returned by _get_commits_files
+    :return: set of issue ids that may be referenced by the commits
+    """
+    candidate_ids = set()
+    for git_commit in java_commits:
+        if any(x.is_java for x in git_commit.files):
+            candidate_ids.update(_get_commit_text_numbers(_clean_commit_message(git_commit.message)))
+    return candidate_ids
+
+
+def _commits_and_issues(repo, jira_issues, java_commits=None):
+    issues = {x.issue_id: x for x in jira_issues}
+    issues_dates = sorted(((x, issues[x].creation_time) for x in issues), key=lambda x: x[1], reverse=True)
     def get_bug_num_from_comit_text(commit_text, issues_ids):
-        text = replace("[]?#,:(){}'\"", "", commit_text.lower())
-        text = replace("-_.=", " ", text)
-        text = text.replace('bug', '').replace('fix', '')
-        for word in text.split():
-            if word.isdigit():
-                if word in issues_ids:
-                    return word
+        for word in _get_commit_text_numbers(commit_text):
+            if word in issues_ids:
+                return word
         return "0"
 
+    issues_ids = set(issues.keys())
+    # issues_dates is sorted newest first, so the distances from the epoch are ascending and can be bisected
+    dates_keys = [_EPOCH - date.replace(tzinfo=None) for _, date in issues_dates]
+    first_issue = 0
     commits = []
-    java_commits = _get_commits_files(repo)
-    for commit_sha in java_commits:
-        git_commit = repo.commit(commit_sha)
+    if java_commits is None:
+        java_commits = _get_commits_files(repo)
+    for git_commit in java_commits.values():
         bug_id = "0"
-        if all(list(map(lambda x: not x.is_java, java_commits[commit_sha]))):
-            commit = Commit.init_commit_by_git_commit(git_commit, bug_id, None, java_commits[commit_sha], False)
+        if not any(x.is_java for x in git_commit.files):
+            commit = Commit.init_commit_by_git_commit(git_commit, bug_id, None, git_commit.files, False)
             commits.append(commit)
             continue
         try:
             commit_text = _clean_commit_message(git_commit.message)
         except Exception as e:
             continue
-        ind = 0
-        for ind, (issue_id, date) in enumerate(issues_dates):
-            date_ = date
-            if date_.tzinfo:
-                date_ = date_.replace(tzinfo=None)
-            if git_commit.committed_datetime.replace(tzinfo=None) > date_:
-                break
-        issues_dates = issues_dates[ind:]
-        bug_id = get_bug_num_from_comit_text(commit_text, set(map(lambda x: x[0], issues_dates)))
+        # first issue older than the commit, or the last remaining one if all the issues are newer
+        ind = bisect.bisect_right(dates_keys, _EPOCH - git_commit.committed_datetime.replace(tzinfo=None), lo=first_issue)
+        ind = min(ind, max(len(issues_dates) - 1, first_issue))
+        for issue_id, _ in issues_dates[first_issue:ind]:
+            issues_ids.discard(issue_id)
+        first_issue = ind
+        bug_id = get_bug_num_from_comit_text(commit_text, issues_ids)
         commits.append(
-            Commit.init_commit_by_git_commit(git_commit, bug_id, issues.get(bug_id), java_commits[commit_sha]))
+            Commit.init_commit_by_git_commit(git_commit, bug_id, issues.get(bug_id), git_commit.files))
     return commits
 
 
 def extract_json(repo_path, jira_key, repo_full_name, out_json, out_non_tests_json):
-    issues = get_jira_issues(jira_key)
-    commits = _commits_and_issues(git.Repo(repo_path), issues)
+    repo = git.Repo(repo_path)
+    java_commits = _get_commits_files(repo)
+    # only the issues mentioned by some commit can be linked, so the others are not fetched
+    issues = get_jira_issues(jira_key, issue_ids=_get_candidate_issue_ids(java_commits.values()))
+    commits = _commits_and_issues(repo, issues, java_commits)
     # save_to_json(commits, repo_full_name, out_json)
     # save_to_json(list(filter(lambda x: not x.is_all_tests, commits)), repo_full_name, out_non_tests_json)
-    to_many_files = list(filter(lambda x: len(x._files) < 6, commits))
+    to_many_files = [x for x in commits if len(x._files) < 6]
     save_to_json(to_many_files, repo_full_name, out_json)
-    save_to_json(list(filter(lambda x: not x.is_all_tests, to_many_files)), repo_full_name, out_non_tests_json)
+    save_to_json([x for x in to_many_files if not x.is_all_tests], repo_full_name, out_non_tests_json)
 
 
 def save_to_json(commits, repo_full_name, out_json):
-    issued_ = list(filter(lambda c: c.issue is not None, commits))
-    buggy = list(filter(lambda c: c.issue.type.lower() == 'bug', issued_))
-    bugs_json = list(map(lambda c: {"repo_name": repo_full_name, 'fix_commit_hash': c._commit_id,
-                                    "earliest_issue_date": c.issue.creation_time.strftime("%Y-%m-%dT%H:%M:%SZ")},
-                         buggy))
+    bugs_json = [{"repo_name": repo_full_name, 'fix_commit_hash': c._commit_id,
+                  "earliest_issue_date": c.issue.creation_time.strftime("%Y-%m-%dT%H:%M:%SZ")}
+                 for c in commits if c.issue is not None and c.issue.type.lower() == 'bug']
     with open(out_json, 'w') as out:
         json.dump(bugs_json, out)
 
@@ -249,7 +479,7 @@ if __name__ == "__main__":
     d = _get_commits_files_status(git.Repo(r"c:\temp\camel2"))
     changes = []
     for c in _get_commits_files(git.Repo(r"c:\temp\camel2")).values():
-        for f in c:
+        for f in c.files:
             changes.append(f.get_values())
     d2 = pd.DataFrame(changes)
     d2.to_csv(r"c:\temp\committed.csv", index=False)
@@ -3,12 +3,18 @@ import tempfile
 import json
 import os
 import logging as log
+import sqlite3
 import subprocess
-from typing import List, Set
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, List, Set
 from git import Commit
+from intervaltree import IntervalTree
 from ma_szz import MASZZ
 from options import Options
 
+PATH_TO_REFMINER = os.path.join(Options.PYSZZ_HOME, 'tools/RefactoringMiner-2.0/bin/RefactoringMiner')
+
 
 class RASZZ(MASZZ):
     """
@@ -18,32 +24,108 @@ class RASZZ(MASZZ):
 
     """
 
+    CACHE_COMMIT_EVERY = 10  # number of new cache entries written before committing to disk
+    CACHE_LOOKUP_BATCH = 500  # commits looked up per query, below the SQLite limit of bound parameters
+
     def __init__(self, repo_full_name: str, repo_url: str, repos_dir: str = None):
         super().__init__(repo_full_name, repo_url, repos_dir)
         self.refactorings = dict()
-        
+        self._ref_intervals = dict()
+        self._blame_cache = dict()
+        self._pending_cache_writes = 0
+        self._cache_conn = self._open_cache(repo_full_name)
+
+    def __del__(self):
+        self._close_cache()
+        super().__del__()
+
+    def _open_cache(self, repo_full_name: str) -> sqlite3.Connection:
+        """
+        Open (and create if needed) the on-disk cache of Refactoring Miner results for the given repository.
+
+        :param str repo_full_name: full name of the Git repository
+        :returns sqlite3.Connection cache connection
+        """
+        cache_dir = os.path.join(Options.PYSZZ_HOME, '.refminer_cache')
+        os.makedirs(cache_dir, exist_ok=True)
+        cache_path = os.path.join(cache_dir, f"{repo_full_name.replace('/', '_')}.sqlite")
+        conn = sqlite3.connect(cache_path)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS cache (commit_sha TEXT PRIMARY KEY, refactorings_json TEXT)')
+        conn.commit()
+        return conn
+
+    def _cache_refactorings(self, commit: str, refactorings: list):
+        self.refactorings[commit] = refactorings
+        self._cache_conn.execute('INSERT OR REPLACE INTO cache (commit_sha, refactorings_json) VALUES (?, ?)',
+                                 (commit, json.dumps(refactorings)))
+        self._pending_cache_writes += 1
+        if self._pending_cache_writes >= self.CACHE_COMMIT_EVERY:
+            self._cache_conn.commit()
+            self._pending_cache_writes = 0
+
+    def _load_cached_refactorings(self, commits: List[str]):
+        """
+        Load from the on-disk cache the refactorings of the given commits, if they were analyzed in a previous run.
+
+        :param List[str] commits: commits not yet in self.refactorings
+        """
+        for i in range(0, len(commits), self.CACHE_LOOKUP_BATCH):
+            batch = commits[i:i + self.CACHE_LOOKUP_BATCH]
+            query = 'SELECT commit_sha, refactorings_json FROM cache WHERE commit_sha IN ({})'.format(','.join('?' * len(batch)))
+            for commit, refactorings_json in self._cache_conn.execute(query, batch):
+                self.refactorings[commit] = json.loads(refactorings_json)
+
+    def _close_cache(self):
+        conn = getattr(self, '_cache_conn', None)
+        if conn is not None:
+            conn.commit()
+            conn.close()
+            self._cache_conn = None
+
+    def _get_refactoring_intervals(self, commit: str) -> Dict[str, IntervalTree]:
+        """
+        Get the line ranges of the refactorings detected in the given commit, as one interval tree per file. Trees are
+        built once per commit and reused by the recursive calls of _blame.
+
+        :param str commit: hash of an already analyzed commit
+        :returns Dict[str, IntervalTree] refactoring line ranges by file path, labelled with the refactoring type
+        """
+        if commit not in self._ref_intervals:
+            intervals = defaultdict(IntervalTree)
+            for refactoring in self.refactorings[commit]:
+                for location in refactoring['rightSideLocations']:
+                    if location['startLine'] <= location['endLine']:
+                        intervals[location['filePath']].addi(location['startLine'], location['endLine'] + 1, refactoring['type'])
+            self._ref_intervals[commit] = dict(intervals)
+        return self._ref_intervals[commit]
+
     def _extract_refactorings(self, commits):
-        PATH_TO_REFMINER = os.path.join(Options.PYSZZ_HOME, 'tools/RefactoringMiner-2.0/bin/RefactoringMiner')
-        
-        for commit in commits:
-            if not commit in self.refactorings:
-                log.info(f'Running RefMiner on {commit}')
-                command = [PATH_TO_REFMINER, "-c", self._repository_path, commit]
+        to_extract = [commit for commit in commits if not commit in self.refactorings]
+        if not to_extract:
+            return
+
+        self._load_cached_refactorings(to_extract)
+        to_extract = [commit for commit in to_extract if not commit in self.refactorings]
+        if not to_extract:
+            return
+
+        # each RefMiner JVM is multi-threaded on its own, so only half of the CPUs are used
+        max_workers = min(len(to_extract), max(1, (os.cpu_count() or 2) // 2))
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(_run_refminer, self._repository_path, commit): commit for commit in to_extract}
+            for future in as_completed(futures):
+                commit = futures[future]
+                # failures are not cached on disk, so that the commit is analyzed again in a later run
                 try:
-                    out = subprocess.check_output(command, stderr=subprocess.DEVNULL, timeout=300)
-                    data = json.loads(out.decode('utf-8')) 
-                    if 'commits' in data and len(data['commits']) > 0 and 'refactorings' in data['commits'][0]:
-                        self.refactorings[commit] = data['commits'][0]['refactorings'] 
-                    else:
-                        log.info("Refactoring format corrupted for commit: {}".format(commit))
-                        self.refactorings[commit] = []
-                    #p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                except subprocess.CalledProcessError as e:
-                    log.error(e)
+                    self._cache_refactorings(*future.result())
                 except subprocess.TimeoutExpired as e:
                     log.error("Command timed out: {}".format(e))
                     self.refactorings[commit] = []
-    
+                except (subprocess.CalledProcessError, OSError, ValueError) as e:
+                    log.error(f'RefMiner failed on commit {commit}: {e}')
+                    self.refactorings[commit] = []
+
     def get_impacted_files(self, fix_commit_hash: str,
                            file_ext_to_parse: List[str] = None,
                            only_deleted_lines: bool = True) -> List['ImpactedFile']:
@@ -51,18 +133,21 @@ class RASZZ(MASZZ):
         
         self._extract_refactorings([fix_commit_hash])
         
+        refs_by_file = defaultdict(list)
         for refactoring in self.refactorings[fix_commit_hash]:
             for location in refactoring['rightSideLocations']:
-                file_path = location['filePath']
-                from_line = location['startLine']
-                to_line   = location['endLine']
-                for f in impacted_files:
-                    lines_to_remove = set()
-                    for modified_line in f.modified_lines:
-                        if file_path == f.file_path and modified_line >= from_line and modified_line <= to_line:
-                            log.info(f'Ignoring {f.file_path} line {modified_line} (refactoring {refactoring["type"]})')
-                            lines_to_remove.add(modified_line)
-                    f.modified_lines = [line for line in f.modified_lines if not line in lines_to_remove]
+                refs_by_file[location['filePath']].append((location['startLine'], location['endLine'], refactoring['type']))
+
+        for f in impacted_files:
+            if f.file_path not in refs_by_file:
+                continue
+            lines_to_remove = set()
+            for from_line, to_line, refactoring_type in refs_by_file[f.file_path]:
+                for modified_line in f.modified_lines:
+                    if from_line <= modified_line <= to_line and modified_line not in lines_to_remove:
+                        log.info(f'Ignoring {f.file_path} line {modified_line} (refactoring {refactoring_type})')
+                        lines_to_remove.add(modified_line)
+            f.modified_lines = [line for line in f.modified_lines if not line in lines_to_remove]
         
         impacted_files = [f for f in impacted_files if len(f.modified_lines) > 0]
         return impacted_files
@@ -78,13 +163,23 @@ class RASZZ(MASZZ):
                detect_move_within_file: bool = False,
                detect_move_from_other_files: 'DetectLineMoved' = None
                ) -> Set['BlameData']:
+        # ignore_revs_list may also be a set, as passed by the recursive calls below
+        ignore_revs_set = set(ignore_revs_list or [])
+        # rev may be relative (e.g. HEAD^) and the working tree moves between fix commits, so the key uses the hash
+        cache_key = (self.repository.rev_parse(rev).hexsha, file_path, frozenset(modified_lines), skip_comments,
+                     frozenset(ignore_revs_set), ignore_revs_file_path, ignore_whitespaces,
+                     detect_move_within_file, detect_move_from_other_files)
+        if cache_key in self._blame_cache:
+            log.info(f'Reusing blame of {file_path} @ {rev}')
+            return set(self._blame_cache[cache_key])
+
         log.info("Running super-blame")
         candidate_blame_data = super()._blame(
             rev,
             file_path, 
             modified_lines, 
             skip_comments, 
-            ignore_revs_list, 
+            ignore_revs_set, 
             ignore_revs_file_path, 
             ignore_whitespaces, 
             detect_move_within_file, 
@@ -94,49 +189,69 @@ class RASZZ(MASZZ):
         commits = set([blame.commit.hexsha for blame in candidate_blame_data])
         self._extract_refactorings(commits)
         
-        to_reblame = dict()
+        # rev -> file path -> lines to re-blame
+        to_reblame = defaultdict(dict)
         
         result_blame_data = set()
         for blame in candidate_blame_data:
-            can_add = True
-            for refactoring in self.refactorings[blame.commit.hexsha]:
-                for location in refactoring['rightSideLocations']:
-                    file_path = location['filePath']
-                    from_line = location['startLine']
-                    to_line   = location['endLine']
-                    
-                    if blame.file_path == file_path and blame.line_num >= from_line and blame.line_num <= to_line:
-                        log.info(f'Ignoring {blame.file_path} line {blame.line_num} (refactoring {refactoring["type"]})')
-                        if not (blame.commit.hexsha + "@" + blame.file_path) in to_reblame:
-                            to_reblame[blame.commit.hexsha + "@" + blame.file_path] = ReblameCandidate(blame.commit.hexsha, blame.file_path, [blame.line_num])
-                        else:
-                            to_reblame[blame.commit.hexsha + "@" + blame.file_path].modified_lines.append(blame.line_num)
-                        can_add = False
-                    
-            if can_add:
+            file_intervals = self._get_refactoring_intervals(blame.commit.hexsha).get(blame.file_path)
+            hits = file_intervals[blame.line_num] if file_intervals else set()
+            for hit in hits:
+                log.info(f'Ignoring {blame.file_path} line {blame.line_num} (refactoring {hit.data})')
+
+            if hits:
+                rev_candidates = to_reblame[blame.commit.hexsha]
+                if not blame.file_path in rev_candidates:
+                    rev_candidates[blame.file_path] = ReblameCandidate(blame.commit.hexsha, blame.file_path, [blame.line_num])
+                else:
+                    rev_candidates[blame.file_path].modified_lines.append(blame.line_num)
+            else:
                 result_blame_data.add(blame)
                 
-        for _, reblame_candidate in to_reblame.items():
-            log.info(f'Re-blaming {reblame_candidate.file_path} @ {reblame_candidate.rev}, lines {reblame_candidate.modified_lines} because of refactoring')
-            if reblame_candidate.rev in ignore_revs_list:
+        for reblame_rev, rev_candidates in to_reblame.items():
+            if reblame_rev in ignore_revs_set:
                 continue
-            new_ignore_revs_list = ignore_revs_list.copy()
-            new_ignore_revs_list.append(reblame_candidate.rev)
-            
-            new_blame_results = self._blame(
-                reblame_candidate.rev,
-                reblame_candidate.file_path,
-                reblame_candidate.modified_lines,
-                skip_comments, 
-                new_ignore_revs_list, 
-                ignore_revs_file_path, 
-                ignore_whitespaces, 
-                detect_move_within_file, 
-                detect_move_from_other_files
-            )
-            result_blame_data.update(new_blame_results)
+            new_ignore_revs_set = ignore_revs_set | {reblame_rev}
+
+            for reblame_candidate in rev_candidates.values():
+                log.info(f'Re-blaming {reblame_candidate.file_path} @ {reblame_candidate.rev}, lines {reblame_candidate.modified_lines} because of refactoring')
+                new_blame_results = self._blame(
+                    reblame_candidate.rev,
+                    reblame_candidate.file_path,
+                    sorted(reblame_candidate.modified_lines),
+                    skip_comments, 
+                    new_ignore_revs_set, 
+                    ignore_revs_file_path, 
+                    ignore_whitespaces, 
+                    detect_move_within_file, 
+                    detect_move_from_other_files
+                )
+                result_blame_data.update(new_blame_results)
         
-        return result_blame_data
+        self._blame_cache[cache_key] = result_blame_data
+        return set(result_blame_data)
+
+
+def _run_refminer(repo_path: str, commit: str):
+    """
+    Run Refactoring Miner on a single commit. Kept at module level so that it can be used by a process pool.
+
+    :param str repo_path: path of the repository to analyze
+    :param str commit: hash of the commit to analyze
+    :returns tuple (commit, list of refactorings detected by Refactoring Miner)
+    """
+    log.info(f'Running RefMiner on {commit}')
+    # RefMiner 2.0 prints the JSON on stdout, which is sent to a file so that it is not buffered in memory
+    command = [PATH_TO_REFMINER, "-c", repo_path, commit]
+    with tempfile.TemporaryFile() as out:
+        subprocess.run(command, stdout=out, stderr=subprocess.DEVNULL, timeout=300, check=True)
+        out.seek(0)
+        data = json.load(out)
+    if 'commits' in data and len(data['commits']) > 0 and 'refactorings' in data['commits'][0]:
+        return commit, data['commits'][0]['refactorings']
+    log.info("Refactoring format corrupted for commit: {}".format(commit))
+    return commit, []
+
 
 class ReblameCandidate:
     def __init__(self, rev, file_path, modified_lines):